@@ -0,0 +1,219 @@
+# embedder.py
+
+import os
+from abc import ABC, abstractmethod
+import numpy as np
+import onnxruntime as ort
+import torch
+import torch.nn.functional as F
+from transformers import AutoModel, AutoTokenizer
+from langchain.embeddings.base import Embeddings
+
+MODEL_NAME = "sentence-transformers/all-mpnet-base-v2"
+ONNX_MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx_model")
+EMBEDDING_DIMENSION = 768
+# Matches the max_seq_length sentence-transformers uses for all-mpnet-base-v2
+MAX_SEQ_LENGTH = 384
+
+# Function to export the model to ONNX and quantize it to INT8, reusing the saved file on later runs
+def export_quantized_model(model_name: str = MODEL_NAME, save_dir: str = ONNX_MODEL_DIR) -> str:
+    quantized_path = os.path.join(save_dir, "model_quantized.onnx")
+    if os.path.exists(quantized_path):
+        return quantized_path
+
+    # optimum is only needed for the one-off export step
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+    quantizer = ORTQuantizer.from_pretrained(model)
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=save_dir, quantization_config=qconfig)
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(save_dir)
+    return quantized_path
+
+# Function to derive a copy of the quantized model with fixed (batch_size, seq_length) input shapes
+def export_fixed_shape_model(batch_size: int, seq_length: int, model_name: str = MODEL_NAME, save_dir: str = ONNX_MODEL_DIR) -> str:
+    fixed_path = os.path.join(save_dir, f"model_quantized_{batch_size}x{seq_length}.onnx")
+    if os.path.exists(fixed_path):
+        return fixed_path
+
+    import onnx
+    from onnxruntime.tools.onnx_model_utils import fix_output_shapes, make_dim_param_fixed
+
+    model = onnx.load(export_quantized_model(model_name, save_dir))
+    make_dim_param_fixed(model.graph, "batch_size", batch_size)
+    make_dim_param_fixed(model.graph, "sequence_length", seq_length)
+    fix_output_shapes(model)
+    onnx.save(model, fixed_path)
+    return fixed_path
+
+# Function to mean-pool a (batch, seq, dim) hidden state over real tokens and L2-normalize it
+def mean_pool(hidden: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+    hidden = np.ascontiguousarray(hidden, dtype=np.float32)
+    mask = np.ascontiguousarray(attention_mask, dtype=np.float32)
+    # Masked sum as a batched (1, seq) x (seq, dim) matmul, which numpy hands to BLAS for float32
+    pooled = np.matmul(mask[:, None, :], hidden)[:, 0]
+    pooled /= np.clip(mask.sum(axis=1, keepdims=True), 1e-9, None)
+    pooled /= np.linalg.norm(pooled, axis=1, keepdims=True)
+    return pooled
+
+# Base class for embedders producing float32 numpy arrays; LangChain's list API wraps encode().
+# Subclasses set backend_id to identify the model, precision and max_length behind their vectors.
+class _NumpyEmbeddings(Embeddings, ABC):
+    @abstractmethod
+    def encode(self, texts: list) -> np.ndarray:
+        ...
+
+    def embed_documents(self, texts: list) -> list:
+        return self.encode(list(texts)).tolist()
+
+    def embed_query(self, text: str) -> list:
+        return self.encode([text])[0].tolist()
+
+# Base class tokenizing all texts once and embedding them in padded mini-batches
+class _BatchedEmbeddings(_NumpyEmbeddings):
+    return_tensors = "np"
+
+    def __init__(self, tokenizer, batch_size: int, max_length: int):
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+    # Padding strategy for a mini-batch of `rows` texts; by default pad to its longest sequence
+    def _padding(self, rows: int):
+        return True
+
+    @abstractmethod
+    def _embed_batch(self, encoded) -> np.ndarray:
+        ...
+
+    # Function to embed texts into one contiguous (N, EMBEDDING_DIMENSION) float32 array
+    def encode(self, texts: list) -> np.ndarray:
+        # One tokenizer call for every text; padding happens per mini-batch below
+        encoded = self.tokenizer(texts, padding=False, truncation=True, max_length=self.max_length)
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            input_ids = encoded["input_ids"][start:start + self.batch_size]
+            batch = self.tokenizer.pad(
+                {
+                    "input_ids": input_ids,
+                    "attention_mask": encoded["attention_mask"][start:start + self.batch_size]
+                },
+                padding=self._padding(len(input_ids)),
+                max_length=self.max_length,
+                return_tensors=self.return_tensors
+            )
+            vectors.append(self._embed_batch(batch))
+
+        if not vectors:
+            return np.empty((0, EMBEDDING_DIMENSION), dtype=np.float32)
+        return np.concatenate(vectors).astype(np.float32, copy=False)
+
+# LangChain embeddings backed by the INT8 ONNX model running on ONNX Runtime.
+# With fixed_shape=True, full mini-batches run on a graph specialized to (batch_size, max_length)
+# through IO binding on preallocated buffers, and short batches (cache misses, the last batch of a
+# run) fall back to the dynamic-shape session. Instances are then not safe to share across threads.
+class ONNXEmbeddings(_BatchedEmbeddings):
+    def __init__(self, model_name: str = MODEL_NAME, batch_size: int = 64, max_length: int = MAX_SEQ_LENGTH, fixed_shape: bool = False, num_threads: int = 0):
+        model_path = export_quantized_model(model_name)
+        super().__init__(AutoTokenizer.from_pretrained(os.path.dirname(model_path)), batch_size, max_length)
+        # Fixed- and dynamic-shape sessions share weights, so their vectors are interchangeable
+        self.backend_id = f"{model_name}:onnx-int8:{max_length}"
+        options = ort.SessionOptions()
+        # 0 lets ONNX Runtime choose its own default
+        options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+        self.fixed_shape = fixed_shape
+        if fixed_shape:
+            fixed_path = export_fixed_shape_model(batch_size, max_length, model_name)
+            self.fixed_session = ort.InferenceSession(fixed_path, options, providers=["CPUExecutionProvider"])
+
+            # Inputs and output live in fixed numpy buffers that ONNX Runtime reads and writes in place
+            self._inputs = {
+                name: np.zeros((batch_size, max_length), dtype=np.int64)
+                for name in self.input_names
+            }
+            self._output = np.empty((batch_size, max_length, EMBEDDING_DIMENSION), dtype=np.float32)
+            self._binding = self.fixed_session.io_binding()
+            for name, buffer in self._inputs.items():
+                self._binding.bind_ortvalue_input(name, ort.OrtValue.ortvalue_from_numpy(buffer))
+            self._binding.bind_ortvalue_output(
+                self.fixed_session.get_outputs()[0].name,
+                ort.OrtValue.ortvalue_from_numpy(self._output)
+            )
+
+    def _uses_fixed_graph(self, rows: int) -> bool:
+        return self.fixed_shape and rows == self.batch_size
+
+    def _padding(self, rows: int):
+        return "max_length" if self._uses_fixed_graph(rows) else True
+
+    def _embed_batch(self, encoded) -> np.ndarray:
+        if not self._uses_fixed_graph(len(encoded["input_ids"])):
+            inputs = {name: encoded[name].astype(np.int64) for name in self.input_names}
+            hidden = self.session.run(None, inputs)[0]
+            return mean_pool(hidden, encoded["attention_mask"])
+
+        for name, buffer in self._inputs.items():
+            buffer[:] = encoded[name]
+        self.fixed_session.run_with_iobinding(self._binding)
+        return mean_pool(self._output, self._inputs["attention_mask"])
+
+# LangChain embeddings running the PyTorch model in bfloat16, pooling in float32
+class TorchEmbeddings(_BatchedEmbeddings):
+    return_tensors = "pt"
+
+    def __init__(self, model_name: str = MODEL_NAME, batch_size: int = 64, max_length: int = MAX_SEQ_LENGTH, device: str = None):
+        super().__init__(AutoTokenizer.from_pretrained(model_name), batch_size, max_length)
+        self.backend_id = f"{model_name}:torch-bf16:{max_length}"
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = AutoModel.from_pretrained(model_name, torch_dtype=torch.bfloat16).to(self.device).eval()
+
+    def _embed_batch(self, encoded) -> np.ndarray:
+        encoded = encoded.to(self.device)
+        with torch.inference_mode():
+            output = self.model(**encoded)
+
+        # Upcast only the final hidden state so pooling and normalization run in float32
+        hidden = output.last_hidden_state.float()
+        mask = encoded["attention_mask"].unsqueeze(-1).float()
+        pooled = (hidden * mask).sum(1) / mask.sum(1).clamp(min=1e-9)
+        return F.normalize(pooled, dim=1).cpu().numpy()
+
+# LangChain embeddings running sentence-transformers in FP16 on the GPU
+class STEmbeddings(_NumpyEmbeddings):
+    def __init__(self, model_name: str = MODEL_NAME, batch_size: int = 128, device: str = "cuda"):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device=device)
+        self.model.half()
+        self.backend_id = f"{model_name}:st-fp16:{self.model.max_seq_length}"
+        self.batch_size = batch_size
+
+    # Function to embed texts into one contiguous (N, EMBEDDING_DIMENSION) float32 array
+    def encode(self, texts: list) -> np.ndarray:
+        embeddings = self.model.encode(
+            texts,
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+        # FP16 outputs are widened so every backend hands out float32 vectors
+        return embeddings.astype(np.float32, copy=False)
+
+# Function to pick the embeddings backend. EMBEDDING_BACKEND may be "st" (FP16 sentence-transformers,
+# GPU), "torch" (BF16 PyTorch) or "onnx" (INT8 ONNX Runtime, CPU); unset, it is "st" when CUDA is
+# available and "onnx" otherwise. gpu_batch_size applies to "st", the rest use batch_size.
+def load_embeddings(batch_size: int = 64, gpu_batch_size: int = 128, fixed_shape: bool = False, num_threads: int = 0) -> Embeddings:
+    backend = os.getenv("EMBEDDING_BACKEND") or ("st" if torch.cuda.is_available() else "onnx")
+    if backend == "st":
+        return STEmbeddings(batch_size=gpu_batch_size)
+    if backend == "torch":
+        return TorchEmbeddings(batch_size=batch_size)
+    if backend == "onnx":
+        return ONNXEmbeddings(batch_size=batch_size, fixed_shape=fixed_shape, num_threads=num_threads)
+    raise ValueError(f"Unknown EMBEDDING_BACKEND: {backend}")
@@ -1,15 +1,24 @@
 # index_data.py
 
+# Must come first: sizes the torch/OpenMP thread pools before they are created
+from thread_config import NUM_THREADS
 import os
-import json
+import sqlite3
+import hashlib
+import queue
+import asyncio
+import threading
+import httpx
+import ijson
+import orjson
 import requests
-import yfinance as yf
-import concurrent.futures
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 from dotenv import load_dotenv
 from langchain.schema import Document
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain.vectorstores import Pinecone as PineconeVectorStore
 import pinecone
+from embedder import EMBEDDING_DIMENSION, load_embeddings
 
 # Load environment variables
 load_dotenv()
@@ -29,129 +38,441 @@ if PINECONE_INDEX_NAME not in pinecone.list_indexes():
         metric="cosine"
     )
 
-# Connect to the index
-index = pinecone.Index(PINECONE_INDEX_NAME)
+# Connect to the index with a thread pool for parallel upserts
+index = pinecone.Index(PINECONE_INDEX_NAME, pool_threads=30)
 
-# Initialize embeddings with explicit model_name to avoid deprecation warning
-hf_embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
+# Yahoo Finance quoteSummary endpoint and the number of concurrent requests against it
+QUOTE_SUMMARY_URL = "https://query2.finance.yahoo.com/v10/finance/quoteSummary/{symbol}"
+# quoteSummary needs Yahoo's session cookie (set by fc.yahoo.com) plus a matching crumb
+YAHOO_COOKIE_URL = "https://fc.yahoo.com"
+YAHOO_CRUMB_URL = "https://query2.finance.yahoo.com/v1/test/getcrumb"
+FETCH_CONCURRENCY = 32
 
-# Initialize vectorstore
-vectorstore = PineconeVectorStore(
-    index_name=PINECONE_INDEX_NAME,
-    embedding=hf_embeddings,
-    namespace=NAMESPACE
+# Keep-alive pool size for the httpx client run_pipeline shares across every ticker fetch
+HTTP_POOL_SIZE = 64
+
+# Session for the single company_tickers.json download, retrying transient failures
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=1,
+    max_retries=Retry(total=3, backoff_factor=0.3)
+))
+
+# Retries for rate-limited (HTTP 429) fetches; the delay doubles after each attempt
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 1.0
+
+# Number of documents per embedding forward pass (CPU and GPU) and vectors per Pinecone upsert request
+BATCH_SIZE = 64
+GPU_BATCH_SIZE = 128
+UPSERT_BATCH_SIZE = 100
+
+# Bounds on the queues between the fetch, embed and upsert stages
+FETCH_QUEUE_SIZE = 256
+UPSERT_QUEUE_SIZE = 8
+
+# Embed batches are cut from a length-sorted window of this many batches' worth of Documents
+SORT_WINDOW_BATCHES = 8
+# Upsert requests allowed in flight at once
+MAX_PENDING_UPSERTS = 8
+
+# Initialize embeddings (FP16 sentence-transformers on GPU, fixed-shape INT8 ONNX Runtime on CPU)
+hf_embeddings = load_embeddings(
+    batch_size=BATCH_SIZE,
+    gpu_batch_size=GPU_BATCH_SIZE,
+    fixed_shape=True,
+    num_threads=NUM_THREADS
 )
 
-# Tracking lists for processed tickers
-successful_tickers = []
-unsuccessful_tickers = []
+# Embedding cache keyed by the sha256 of the embedder's backend id and the text, so unchanged summaries skip the model
+embedding_cache = sqlite3.connect('emb_cache.db', check_same_thread=False)
+embedding_cache.execute("CREATE TABLE IF NOT EXISTS cache (hash TEXT PRIMARY KEY, vec BLOB)")
+
+# Tracking sets for processed tickers
+successful_tickers = set()
+unsuccessful_tickers = set()
 
 # Function to load tickers from a file
 def load_tickers(file_path):
     try:
         with open(file_path, 'r') as f:
-            return [line.strip() for line in f if line.strip()]
+            return set(line.strip() for line in f if line.strip())
     except FileNotFoundError:
-        return []
+        return set()
 
 # Load existing successful/unsuccessful tickers
 successful_tickers = load_tickers('successful_tickers.txt')
 unsuccessful_tickers = load_tickers('unsuccessful_tickers.txt')
 
+# Lines for the ticker log files, (file_path, line) tuples written by a single writer thread
+log_queue = queue.Queue()
+LOG_FLUSH_EVERY = 50
+
+# Function run by the writer thread; flushes every LOG_FLUSH_EVERY lines or when the queue drains
+def log_writer() -> None:
+    files = {}
+    pending = 0
+    try:
+        while True:
+            item = log_queue.get()
+            if item is None:
+                break
+            file_path, line = item
+            if file_path not in files:
+                files[file_path] = open(file_path, 'a', buffering=1 << 16)
+            files[file_path].write(line)
+            pending += 1
+            if pending >= LOG_FLUSH_EVERY or log_queue.empty():
+                for f in files.values():
+                    f.flush()
+                pending = 0
+    finally:
+        for f in files.values():
+            f.close()
+
+# Yahoo's cookie + crumb pair, fetched once per run and refreshed when Yahoo rejects it
+class YahooCrumb:
+    def __init__(self, client: httpx.AsyncClient):
+        self.client = client
+        self.value = None
+        self._lock = asyncio.Lock()
+
+    async def get(self) -> str:
+        if self.value is None:
+            return await self.refresh(None)
+        return self.value
+
+    async def refresh(self, stale: str) -> str:
+        async with self._lock:
+            # Another worker may already have replaced the stale crumb while we waited
+            if self.value == stale:
+                # The response is usually a 404; only the cookie it sets matters
+                await self.client.get(YAHOO_COOKIE_URL)
+                response = await self.client.get(YAHOO_CRUMB_URL)
+                response.raise_for_status()
+                crumb = response.text.strip()
+                if not crumb or "<" in crumb:
+                    raise ValueError(f"Unexpected crumb response: {crumb[:100]}")
+                self.value = crumb
+        return self.value
+
 # Function to fetch stock information
-def get_stock_info(symbol: str) -> dict:
-    data = yf.Ticker(symbol)
-    stock_info = data.info
+async def fetch_info(client: httpx.AsyncClient, crumb: YahooCrumb, symbol: str) -> dict:
+    async def request(crumb_value: str) -> httpx.Response:
+        return await client.get(
+            QUOTE_SUMMARY_URL.format(symbol=symbol),
+            params={"modules": "assetProfile,price", "crumb": crumb_value}
+        )
+
+    crumb_value = await crumb.get()
+    response = await request(crumb_value)
+    if response.status_code == 401:
+        # "Invalid Crumb": the cookie or crumb expired, so fetch a new pair and try once more
+        response = await request(await crumb.refresh(crumb_value))
+    response.raise_for_status()
+    quote_summary = orjson.loads(response.content)["quoteSummary"]
+    if not quote_summary.get("result"):
+        raise ValueError(f"No quoteSummary result: {quote_summary.get('error')}")
+
+    result = quote_summary["result"][0]
+    profile = result.get("assetProfile") or {}
+    price = result.get("price") or {}
     properties = {
-        "Ticker": stock_info.get('symbol', 'Information not available'),
-        "Name": stock_info.get('longName', 'Information not available'),
-        "Business Summary": stock_info.get('longBusinessSummary') or "No data available",
-        "City": stock_info.get('city', 'Information not available'),
-        "State": stock_info.get('state', 'Information not available'),
-        "Country": stock_info.get('country', 'Information not available'),
-        "Industry": stock_info.get('industry', 'Information not available'),
-        "Sector": stock_info.get('sector', 'Information not available')
+        "Ticker": price.get('symbol', 'Information not available'),
+        "Name": price.get('longName', 'Information not available'),
+        "Business Summary": profile.get('longBusinessSummary') or "No data available",
+        "City": profile.get('city', 'Information not available'),
+        "State": profile.get('state', 'Information not available'),
+        "Country": profile.get('country', 'Information not available'),
+        "Industry": profile.get('industry', 'Information not available'),
+        "Sector": profile.get('sector', 'Information not available')
     }
     return properties
 
-# Function to process and index a single stock
-def process_stock(stock_ticker: str) -> str:
+# Function to build the Document for a single stock
+async def process_stock(client: httpx.AsyncClient, crumb: YahooCrumb, stock_ticker: str):
     if stock_ticker in successful_tickers:
-        return f"Already processed {stock_ticker}"
+        return None
+    stock_data = await fetch_info(client, crumb, stock_ticker)
+    stock_description = stock_data['Business Summary']
+    if not isinstance(stock_description, str):
+        stock_description = "No summary available"
+
+    # Ensure all metadata values are valid
+    for key, value in stock_data.items():
+        if value is None:
+            stock_data[key] = "No data available"
+        elif isinstance(value, list):
+            stock_data[key] = [str(item) for item in value]
+        elif not isinstance(value, (str, int, float, bool)):
+            stock_data[key] = str(value)
+
+    return Document(page_content=stock_description, metadata=stock_data)
+
+# Function to embed texts, reusing cached vectors and embedding only the misses in one batch
+def embed_with_cache(texts: list) -> np.ndarray:
+    embeddings = np.empty((len(texts), EMBEDDING_DIMENSION), dtype=np.float32)
+    # The backend id is part of the key so vectors from another model or precision are never reused
+    hashes = [
+        hashlib.sha256(f"{hf_embeddings.backend_id}\0{text}".encode('utf-8')).hexdigest()
+        for text in texts
+    ]
+    unique_hashes = list(set(hashes))
+    placeholders = ",".join("?" * len(unique_hashes))
+    cached = dict(embedding_cache.execute(
+        f"SELECT hash, vec FROM cache WHERE hash IN ({placeholders})",
+        unique_hashes
+    ).fetchall())
+
+    misses = {}
+    for i, text_hash in enumerate(hashes):
+        if text_hash in cached:
+            embeddings[i] = np.frombuffer(cached[text_hash], dtype=np.float32)
+        else:
+            misses.setdefault(text_hash, []).append(i)
+
+    if misses:
+        # Identical texts within the batch are embedded only once
+        first_indices = [indices[0] for indices in misses.values()]
+        vectors = hf_embeddings.encode([texts[i] for i in first_indices])
+        for indices, vector in zip(misses.values(), vectors):
+            embeddings[indices] = vector
+        with embedding_cache:
+            embedding_cache.executemany(
+                "INSERT OR REPLACE INTO cache (hash, vec) VALUES (?, ?)",
+                [(text_hash, vector.tobytes()) for text_hash, vector in zip(misses, vectors)]
+            )
+    return embeddings
+
+# Function to upsert vectors in parallel chunks, waiting for every request to finish
+def upsert_batch(ids: list, embeddings, metadatas: list) -> list:
+    futures = []
+    for start in range(0, len(ids), UPSERT_BATCH_SIZE):
+        end = start + UPSERT_BATCH_SIZE
+        # Embeddings stay in one float32 array until the chunk is serialized
+        vectors = list(zip(ids[start:end], embeddings[start:end].tolist(), metadatas[start:end]))
+        futures.append(index.upsert(vectors=vectors, namespace=NAMESPACE, async_req=True))
+    return [future.get() for future in futures]
+
+# Function to record tickers whose vectors have been upserted
+def record_success(tickers: list) -> None:
+    for ticker in tickers:
+        log_queue.put(('successful_tickers.txt', f"{ticker}\n"))
+        successful_tickers.add(ticker)
+        print(f"Processed {ticker} successfully")
+
+# Function to tell whether a fetch failed because Yahoo is rate limiting us
+def is_rate_limited(exc: Exception) -> bool:
+    return isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 429
+
+# Function to process a stock, backing off exponentially while rate limited
+async def process_stock_with_retry(client: httpx.AsyncClient, crumb: YahooCrumb, stock_ticker: str):
+    for attempt in range(MAX_RETRIES):
+        try:
+            return await process_stock(client, crumb, stock_ticker)
+        except Exception as exc:
+            if not is_rate_limited(exc) or attempt == MAX_RETRIES - 1:
+                raise
+            delay = RETRY_BACKOFF_SECONDS * 2 ** attempt
+            print(f"Rate limited on {stock_ticker}, retrying in {delay:.0f}s")
+            await asyncio.sleep(delay)
+
+# Function run in a worker thread: drains the (possibly blocking) ticker iterable onto ticker_q.
+# The queue is unbounded, so a streamed download is read to the end and closed straight away.
+def feed_tickers(tickers, ticker_q: asyncio.Queue, loop: asyncio.AbstractEventLoop, stop: threading.Event) -> None:
+    count = 0
+    try:
+        for ticker in tickers:
+            # Set when the run is aborting; stop reading instead of queueing tickers nobody will fetch
+            if stop.is_set():
+                break
+            loop.call_soon_threadsafe(ticker_q.put_nowait, ticker)
+            count += 1
+    except Exception as exc:
+        # Keep the tickers read so far; the fetch workers finish those and the run ends normally
+        print(f"Ticker stream failed after {count} tickers: {exc}")
+    finally:
+        # One sentinel per fetch worker
+        for _ in range(FETCH_CONCURRENCY):
+            loop.call_soon_threadsafe(ticker_q.put_nowait, None)
+
+# Fetch stage: each worker takes tickers from ticker_q and queues their Documents
+async def fetch_worker(client: httpx.AsyncClient, crumb: YahooCrumb, ticker_q: asyncio.Queue, fetch_q: asyncio.Queue) -> None:
+    while True:
+        ticker = await ticker_q.get()
+        if ticker is None:
+            return
+        try:
+            doc = await process_stock_with_retry(client, crumb, ticker)
+        except Exception as exc:
+            # Still rate limited after every retry: stop the run rather than fail every remaining ticker
+            if is_rate_limited(exc):
+                print(f"Rate limit persisted while fetching {ticker}")
+                raise
+
+            # Record failure and move on to the next ticker
+            log_queue.put(('unsuccessful_tickers.txt', f"{ticker}\n"))
+            unsuccessful_tickers.add(ticker)
+            print(f'{ticker} generated an exception: {exc}')
+            continue
+        if doc is None:
+            print(f"Already processed {ticker}")
+        else:
+            await fetch_q.put((ticker, doc))
+
+# Embed stage: length-sorts a window of Documents, then embeds it batch by batch, handing (ids, vectors, metadatas) on
+async def embed_stage(fetch_q: asyncio.Queue, upsert_q: asyncio.Queue) -> None:
+    batch_size = hf_embeddings.batch_size
+    window = []
+    while True:
+        item = await fetch_q.get()
+        if item is not None:
+            window.append(item)
+        if window and (item is None or len(window) == batch_size * SORT_WINDOW_BATCHES):
+            # Sorting by length keeps padding within each embedding mini-batch to a minimum
+            window.sort(key=lambda pair: len(pair[1].page_content))
+            for start in range(0, len(window), batch_size):
+                batch = window[start:start + batch_size]
+                texts = [doc.page_content for _, doc in batch]
+                embeddings = await asyncio.to_thread(embed_with_cache, texts)
+
+                # The page content is stored under "text", the key main.py's vectorstore reads it from
+                ids = [ticker for ticker, _ in batch]
+                metadatas = [{**doc.metadata, "text": doc.page_content} for _, doc in batch]
+                await upsert_q.put((ids, embeddings, metadatas))
+            window = []
+        if item is None:
+            await upsert_q.put(None)
+            return
+
+# Function to upsert one chunk of vectors and record its tickers once Pinecone has them
+async def upsert_and_record(ids: list, embeddings, metadatas: list) -> None:
+    await asyncio.to_thread(upsert_batch, ids, embeddings, metadatas)
+    record_success(ids)
+
+# Upsert stage: cuts buffered vectors into UPSERT_BATCH_SIZE requests, keeping several in flight
+async def upsert_stage(upsert_q: asyncio.Queue) -> None:
+    ids, metadatas = [], []
+    embeddings = np.empty((0, EMBEDDING_DIMENSION), dtype=np.float32)
+    pending = set()
+
+    async def submit(count: int) -> None:
+        nonlocal ids, embeddings, metadatas, pending
+        while len(pending) >= MAX_PENDING_UPSERTS:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()  # re-raise upsert errors
+        pending.add(asyncio.create_task(
+            upsert_and_record(ids[:count], embeddings[:count], metadatas[:count])
+        ))
+        ids, embeddings, metadatas = ids[count:], embeddings[count:], metadatas[count:]
+
     try:
-        stock_data = get_stock_info(stock_ticker)
-        stock_description = stock_data['Business Summary']
-        if not isinstance(stock_description, str):
-            stock_description = "No summary available"
-
-        # Ensure all metadata values are valid
-        for key, value in stock_data.items():
-            if value is None:
-                stock_data[key] = "No data available"
-            elif isinstance(value, list):
-                stock_data[key] = [str(item) for item in value]
-            elif not isinstance(value, (str, int, float, bool)):
-                stock_data[key] = str(value)
-
-        # Create a Document
-        doc = Document(page_content=stock_description, metadata=stock_data)
-        vectorstore.add_documents([doc])
-
-        # Record success
-        with open('successful_tickers.txt', 'a') as f:
-            f.write(f"{stock_ticker}\n")
-        successful_tickers.append(stock_ticker)
-
-        return f"Processed {stock_ticker} successfully"
-
-    except Exception as e:
-        # Record failure
-        with open('unsuccessful_tickers.txt', 'a') as f:
-            f.write(f"{stock_ticker}\n")
-        unsuccessful_tickers.append(stock_ticker)
-        return f"ERROR processing {stock_ticker}: {e}"
-
-# Function to process stocks in parallel
-def parallel_process_stocks(tickers: list, max_workers: int = 10) -> None:
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_ticker = {
-            executor.submit(process_stock, ticker): ticker
-            for ticker in tickers
-        }
-
-        for future in concurrent.futures.as_completed(future_to_ticker):
-            ticker = future_to_ticker[future]
+        while True:
+            item = await upsert_q.get()
+            if item is None:
+                break
+            ids.extend(item[0])
+            embeddings = np.concatenate([embeddings, item[1]])
+            metadatas.extend(item[2])
+            # Send full requests only; the remainder waits for the next batch
+            while len(ids) >= UPSERT_BATCH_SIZE:
+                await submit(UPSERT_BATCH_SIZE)
+        if ids:
+            await submit(len(ids))
+        await asyncio.gather(*pending)
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        raise
+
+# Function to run the fetch -> embed -> upsert pipeline with the stages overlapping
+async def run_pipeline(tickers) -> None:
+    fetch_q = asyncio.Queue(maxsize=FETCH_QUEUE_SIZE)
+    upsert_q = asyncio.Queue(maxsize=UPSERT_QUEUE_SIZE)
+    ticker_q = asyncio.Queue()
+
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+    )
+    async with httpx.AsyncClient(transport=transport, headers={"User-Agent": "Mozilla/5.0"}, timeout=30) as client:
+        # Fetch the crumb up front so a run that cannot get one stops instead of failing every ticker
+        crumb = YahooCrumb(client)
+        await crumb.get()
+
+        async def produce() -> None:
+            # Reading the ticker source happens off the event loop so it never stalls the other stages
+            stop_feeding = threading.Event()
+            feeder = asyncio.create_task(asyncio.to_thread(
+                feed_tickers, tickers, ticker_q, asyncio.get_running_loop(), stop_feeding
+            ))
+            workers = [
+                asyncio.create_task(fetch_worker(client, crumb, ticker_q, fetch_q))
+                for _ in range(FETCH_CONCURRENCY)
+            ]
             try:
-                result = future.result()
-                print(result)
-                if result.startswith("ERROR"):
-                    print(f"Stopping program due to error in {ticker}")
-                    executor.shutdown(wait=False)
-                    raise SystemExit(1)
-            except Exception as exc:
-                print(f'{ticker} generated an exception: {exc}')
-                print("Stopping program due to exception")
-                executor.shutdown(wait=False)
-                raise SystemExit(1)
-
-# Function to fetch company tickers from GitHub
+                await asyncio.wait(workers, return_when=asyncio.FIRST_EXCEPTION)
+            finally:
+                # A worker hit a persistent rate limit (or the run was cancelled): stop the other
+                # workers while the client is still open, so they don't log unfetched tickers as failed
+                stop_feeding.set()
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+            await feeder
+
+            # Hand everything already fetched on to the embed and upsert stages before reporting
+            await fetch_q.put(None)
+            for worker in workers:
+                if not worker.cancelled() and worker.exception() is not None:
+                    raise worker.exception()
+
+        producer = asyncio.create_task(produce())
+        tasks = [
+            producer,
+            asyncio.create_task(embed_stage(fetch_q, upsert_q)),
+            asyncio.create_task(upsert_stage(upsert_q))
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            if producer in done and not producer.cancelled() and producer.exception() is not None:
+                # Fetching stopped but the sentinel is queued: let embed and upsert drain first
+                await asyncio.gather(*tasks[1:])
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+# Function to process stocks through the pipeline; tickers may be any iterable, including a generator
+def parallel_process_stocks(tickers) -> None:
+    log_thread = threading.Thread(target=log_writer, daemon=True)
+    log_thread.start()
+    try:
+        asyncio.run(run_pipeline(tickers))
+    except Exception:
+        print("Stopping program due to exception")
+        raise SystemExit(1)
+    finally:
+        # Let the writer drain the queue and close both files
+        log_queue.put(None)
+        log_thread.join()
+
+# Function to stream company tickers from GitHub one at a time
 def get_company_tickers():
     url = "https://raw.githubusercontent.com/team-headstart/Financial-Analysis-and-Automation-with-LLMs/main/company_tickers.json"
-    response = requests.get(url)
-    if response.status_code == 200:
-        company_tickers = json.loads(response.content.decode('utf-8'))
-        with open("company_tickers.json", "w", encoding="utf-8") as file:
-            json.dump(company_tickers, file, indent=4)
-        print("File downloaded successfully and saved as 'company_tickers.json'")
-        return company_tickers
-    else:
-        print(f"Failed to download file. Status code: {response.status_code}")
-        return None
+    with SESSION.get(url, stream=True) as response:
+        if response.status_code != 200:
+            print(f"Failed to download file. Status code: {response.status_code}")
+            return
+        # Let urllib3 undo any gzip encoding before ijson parses the raw stream
+        response.raw.decode_content = True
+        for _, stock in ijson.kvitems(response.raw, ''):
+            yield stock['ticker']
 
 # Main execution block
 if __name__ == "__main__":
-    company_tickers = get_company_tickers()
-    if company_tickers:
-        print(f"Number of tickers to process: {len(company_tickers)}")
-        tickers_to_process = [stock['ticker'] for stock in company_tickers.values()]
-        parallel_process_stocks(tickers_to_process, max_workers=10)
+    parallel_process_stocks(get_company_tickers())
@@ -1,15 +1,20 @@
+# Must come first: sizes the torch/OpenMP thread pools before they are created
+from thread_config import NUM_THREADS
+import os
 from fastapi import FastAPI, HTTPException
 from dotenv import load_dotenv
-import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from pinecone import Pinecone, ServerlessSpec
 from langchain.vectorstores import Pinecone as LangChainPineconeVectorStore
-from langchain.embeddings import HuggingFaceEmbeddings
+from embedder import load_embeddings
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 import logging
 from pydantic import BaseModel
 from typing import List, Dict
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -23,6 +28,13 @@ PINECONE_ENVIRONMENT = os.getenv("PINECONE_ENVIRONMENT")
 PINECONE_INDEX_NAME = "stocks"
 namespace = "stock-descriptions"
 
+# Searches arriving within BATCH_WINDOW seconds share one embedding pass, up to MAX_BATCH queries
+MAX_BATCH = 32
+BATCH_WINDOW = 0.008
+
+# Pinecone client threads, enough for two full batches of queries to be in flight at once
+PINECONE_POOL_THREADS = 2 * MAX_BATCH
+
 
 origins = [
     "http://localhost:3000",  # Next.js frontend
@@ -66,18 +78,18 @@ if PINECONE_INDEX_NAME not in pc.list_indexes().names():
 
 # Specify the index
 try:
-    index = pc.Index(PINECONE_INDEX_NAME)
+    index = pc.Index(PINECONE_INDEX_NAME, pool_threads=PINECONE_POOL_THREADS)
     logger.info(f"Connected to Pinecone index: {PINECONE_INDEX_NAME}")
 except Exception as e:
     logger.error("Failed to connect to Pinecone index: %s", str(e))
     raise
 
-# Initialize embeddings with explicit model_name to avoid deprecation warning
+# Initialize embeddings (FP16 sentence-transformers on GPU, INT8 ONNX Runtime on CPU)
 try:
-    hf_embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
-    logger.info("HuggingFaceEmbeddings initialized successfully.")
+    hf_embeddings = load_embeddings(num_threads=NUM_THREADS)
+    logger.info("%s initialized successfully.", type(hf_embeddings).__name__)
 except Exception as e:
-    logger.error("Failed to initialize HuggingFaceEmbeddings: %s", str(e))
+    logger.error("Failed to initialize embeddings: %s", str(e))
     raise
 
 # Initialize LangChain's Pinecone VectorStore with text_key
@@ -105,15 +117,99 @@ class SearchResponse(BaseModel):
     query: str
     results: List[SearchResult]
 
+# Queue of (SearchRequest, Future) pairs drained by search_batcher; created on startup
+search_queue = None
+
+# Threads that block on Pinecone query futures so the event loop never does
+query_waiters = ThreadPoolExecutor(max_workers=PINECONE_POOL_THREADS)
+# Strong references to in-flight resolve tasks so they are not garbage collected
+resolve_tasks = set()
+
+# Function to hand one search its Pinecone result (or error) as soon as that query returns
+async def resolve_search(future: asyncio.Future, pending) -> None:
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(query_waiters, pending.get)
+    except Exception as e:
+        if not future.done():
+            future.set_exception(e)
+        return
+    if not future.done():
+        future.set_result(result)
+
+# Background task coalescing concurrent searches into one embedding call and parallel queries
+async def search_batcher():
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await search_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(search_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            vectors = await asyncio.to_thread(hf_embeddings.encode, [search.query for search, _ in batch])
+        except Exception as e:
+            logger.error("Batched search embedding failed: %s", str(e))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+
+        # Each query resolves its own request; the batcher goes straight back to the queue
+        for (search, future), vector in zip(batch, vectors):
+            try:
+                pending = index.query(
+                    vector=vector.tolist(),
+                    top_k=search.k,
+                    namespace=namespace,
+                    include_metadata=True,
+                    async_req=True
+                )
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            task = asyncio.create_task(resolve_search(future, pending))
+            resolve_tasks.add(task)
+            task.add_done_callback(resolve_tasks.discard)
+
+# Run one embedding and one Pinecone query at startup so the first /research call is not a cold start
+@app.on_event("startup")
+def warmup():
+    try:
+        vector = hf_embeddings.embed_query("warmup")
+        index.query(vector=vector, top_k=1, namespace=namespace)
+        logger.info("Embeddings and Pinecone connection warmed up.")
+    except Exception as e:
+        logger.warning("Warm-up failed: %s", str(e))
+
+@app.on_event("startup")
+async def start_search_batcher():
+    global search_queue
+    search_queue = asyncio.Queue()
+    # Keep a reference so the task is not garbage collected
+    app.state.search_batcher = asyncio.create_task(search_batcher())
+
 @app.post("/research", response_model=SearchResponse)
-def research(search: SearchRequest):
+async def research(search: SearchRequest):
     if not search.query:
         raise HTTPException(status_code=400, detail="Query parameter is required.")
     try:
-        results = vectorstore.similarity_search(search.query, k=search.k)
-        json_results = [
-            SearchResult(text=r.page_content, metadata=r.metadata) for r in results
-        ]
+        future = asyncio.get_running_loop().create_future()
+        await search_queue.put((search, future))
+        response = await future
+
+        # Document text is stored under the vectorstore's text_key, the rest is the metadata
+        json_results = []
+        for match in response.matches:
+            metadata = dict(match.metadata or {})
+            text = metadata.pop("text", "")
+            json_results.append(SearchResult(text=text, metadata=metadata))
         return SearchResponse(query=search.query, results=json_results)
     except Exception as e:
         raise HTTPException(status_code=500, detail="Internal Server Error")
@@ -126,7 +222,9 @@ def test_query(query: str):
         logger.info("Number of results: %d", len(results))
         for i, result in enumerate(results):
             logger.info("Result %d:", i+1)
-            logger.info("Text: %s", result.page_content)
+            # Summaries can run to several KB; only format a truncated copy when INFO is enabled
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Text: %.200s", result.page_content)
             logger.info("Metadata: %s", result.metadata)
             logger.info("---")
     except Exception as e:
@@ -0,0 +1,19 @@
+# thread_config.py
+# Imported first by index_data.py and main.py so these settings apply before torch/onnxruntime load
+
+import os
+
+# Function to count the CPUs this process may run on, honouring container limits and affinity
+def available_cpus() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 4
+
+# Match thread pools to the physical core count, assuming two hardware threads per core
+NUM_THREADS = max(1, available_cpus() // 2)
+os.environ.setdefault("OMP_NUM_THREADS", str(NUM_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(NUM_THREADS))
+
+import torch
+torch.set_num_threads(NUM_THREADS)
+torch.set_num_interop_threads(max(1, NUM_THREADS // 2))